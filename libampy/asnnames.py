@@ -49,30 +49,15 @@ class ASNManager(object):
         if asn == "" or int(asn) < 0:
             return None
 
-        query = "SELECT * FROM asmap WHERE asn=%s"
-        params = (asn,)
-
-        self.dblock.acquire()
-        if self.db.executequery(query, params) == -1:
-            self.dblock.release()
-            log("Error while querying for AS name for %s" % (asn))
-            return None
-
-        if self.db.cursor is None:
-            self.dblock.release()
-            log("Cursor for querying ASDB is None?")
+        asn = int(asn)
+        asnames = self.queryDatabaseMany([asn])
+        if asnames is None:
             return None
 
-        if self.db.cursor.rowcount < 1:
-            self.db.closecursor()
-            self.dblock.release()
+        if asn not in asnames:
             log("ASN %s not found in AS database :(" % (asn))
             return "NotFound"
-
-        asname = self.db.cursor.fetchone()['asname']
-        self.db.closecursor()
-        self.dblock.release()
-        return asname
+        return asnames[asn]
 
     def getASNsByName(self, pagesize=30, offset=0, term=""):
         # sanitize the term so we don't get sql-injected
@@ -110,8 +95,34 @@ class ASNManager(object):
         self.dblock.release()
         return ascount, allasns
 
+    def queryDatabaseMany(self, asns):
+        if len(asns) == 0:
+            return {}
+
+        query = "SELECT asn, asname FROM asmap WHERE asn = ANY(%s)"
+        params = (list(asns),)
+
+        self.dblock.acquire()
+        if self.db.executequery(query, params) == -1:
+            self.dblock.release()
+            log("Error while querying for AS names for %d ASNs" % (len(asns)))
+            return None
+
+        if self.db.cursor is None:
+            self.dblock.release()
+            log("Cursor for querying ASDB is None?")
+            return None
+
+        asnames = {}
+        for row in self.db.cursor:
+            asnames[row['asn']] = row['asname']
+        self.db.closecursor()
+        self.dblock.release()
+        return asnames
+
     def queryASNames(self, toquery):
         asnames = {}
+        uncached = {}
 
         if len(toquery) == 0:
             return asnames
@@ -122,15 +133,23 @@ class ASNManager(object):
                 asnames[q] = cached
                 continue
 
-            queried = self.queryDatabase(q[2:])
-
-            if queried is None:
+            asn = q[2:]
+            if asn == "" or int(asn) < 0:
                 return None
-            elif queried == "NotFound":
+            uncached[int(asn)] = q
+
+        # Look up all of the names that weren't cached using one query
+        queried = self.queryDatabaseMany(list(uncached.keys()))
+        if queried is None:
+            return None
+
+        for asn, q in uncached.items():
+            if asn not in queried:
+                log("ASN %s not found in AS database :(" % (asn))
                 asnames[q] = q
             else:
-                self.cache.store_asname(q, queried)
-                asnames[q] = queried
+                self.cache.store_asname(q, queried[asn])
+                asnames[q] = queried[asn]
 
         return asnames
 
@@ -30,6 +30,9 @@
 
 import time
 import re
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import lru_cache
 from threading import Lock
 
 from libampy.nntsc import NNTSCConnection
@@ -39,6 +42,24 @@ from libnntscclient.logger import log
 
 STREAM_CHECK_FREQ = 60 * 5
 
+# Default binsizes, chosen by finding the first threshold that is at least
+# as large as the minimum binsize for the graph
+BINSIZE_THRESHOLDS = (300, 600, 1200, 2400, 4800)
+BINSIZES = (300, 600, 1200, 2400, 4800, 14400)
+
+# Same as the time we cache a missing matrix view for
+MATRIX_STREAM_CACHE_TIME = 300
+
+# Number of distinct group descriptions to keep the regex matches for
+GROUP_MATCH_CACHE_SIZE = 4096
+
+@lru_cache(maxsize=GROUP_MATCH_CACHE_SIZE)
+def _cached_group_match(regex, description):
+    parts = regex.match(description)
+    if parts is None:
+        return None
+    return parts.groupdict()
+
 class Collection(object):
     """
     Base class for all collection modules.
@@ -126,6 +147,9 @@ class Collection(object):
         self.lastnewstream = 0
         self.collock = Lock()
         self.integerproperties = []
+        self.matrixstreams = OrderedDict()
+        self.matrixstreamsfor = 0
+        self.matrixlock = Lock()
 
         # These members MUST be overridden by the child collection's init
         # function
@@ -202,20 +226,7 @@ class Collection(object):
 
         # Most collections measure at 5 min intervals so use this
         # as a minimum binsize
-        if minbin <= 300:
-            binsize = 300
-        elif minbin <= 600:
-            binsize = 600
-        elif minbin <= 1200:
-            binsize = 1200
-        elif minbin <= 2400:
-            binsize = 2400
-        elif minbin <= 4800:
-            binsize = 4800
-        else:
-            binsize = 14400
-
-        return binsize
+        return BINSIZES[bisect_left(BINSIZE_THRESHOLDS, minbin)]
 
     def create_group_from_list(self, options):
         """
@@ -225,9 +236,10 @@ class Collection(object):
         This is mainly to support creating groups via the web API.
 
         Parameters:
-          options -- the list of properties describing the group. The
-                     properties MUST be in the same order as they are
-                     listed in the groupproperties list for the collection.
+          options -- the list (or tuple) of properties describing the
+                     group. The properties MUST be in the same order as
+                     they are listed in the groupproperties list for the
+                     collection.
 
         Returns:
           a string describing the group or None if no string can be formed
@@ -1195,6 +1207,67 @@ class Collection(object):
 
         return len(streams)
 
+    def _find_matrix_streams(self, props):
+        """
+        Finds the streams that belong to a matrix cell, re-using the
+        result of a recent search for the same cell if possible.
+
+        The same cells are searched for every time a matrix is refreshed,
+        and collections that appear on several matrices search for them
+        once per matrix.
+
+        Cached results are discarded once they are older than
+        MATRIX_STREAM_CACHE_TIME or as soon as any new streams have been
+        added to the stream manager.
+
+        Parameters:
+          props -- the stream properties to search for
+
+        Returns:
+          the list of matching streams, as per StreamManager.find_streams().
+          This list may be shared with other callers, so must not be
+          modified.
+        """
+        key = tuple((prop, props[prop]) for prop in self.streamproperties
+                if prop in props)
+        now = time.time()
+
+        with self.matrixlock:
+            # New streams could belong to any cell, so start again from
+            # scratch
+            if self.matrixstreamsfor != self.lastnewstream:
+                self.matrixstreams = OrderedDict()
+                self.matrixstreamsfor = self.lastnewstream
+            generation = self.matrixstreamsfor
+
+            cached = self.matrixstreams.get(key)
+            if cached is not None and \
+                    now < cached[0] + MATRIX_STREAM_CACHE_TIME:
+                return cached[1]
+
+        # Search without holding the lock, so other threads can still use
+        # the cache in the meantime
+        streams = self.streammanager.find_streams(props)
+
+        with self.matrixlock:
+            # Don't store a result from before the cache was last reset
+            if self.matrixstreamsfor != generation:
+                return streams
+
+            # Entries are kept in the order they were stored, so any that
+            # have expired are at the front
+            while self.matrixstreams:
+                oldest = next(iter(self.matrixstreams))
+                stored = self.matrixstreams.get(oldest)
+                if stored is None or \
+                        now < stored[0] + MATRIX_STREAM_CACHE_TIME:
+                    break
+                del self.matrixstreams[oldest]
+
+            self.matrixstreams.pop(key, None)
+            self.matrixstreams[key] = (now, streams)
+        return streams
+
     def _address_to_family(self, address):
         """
         Handy helper function for converting an IP address to a string
@@ -1207,13 +1280,56 @@ class Collection(object):
         else:
             return 'ipv6'
 
+    def _generate_label(self, baselabel, search, family, lookup):
+        """
+        Creates a label for the streams in a group that belong to a given
+        address family.
+
+        Used by a number of collections, so it is part of the parent class.
+
+        Parameters:
+          baselabel -- the label prefix for the group, e.g. 'group_5'
+          search -- the stream properties to search for, excluding the
+                    address family. This dictionary is not modified.
+          family -- the address family to restrict the label to, e.g.
+                    'IPv4'. If None, streams of any family are included.
+          lookup -- if False, don't search for the matching streams
+
+        Returns:
+          a dictionary describing the label, or None if the stream
+          search fails.
+        """
+        if family is None:
+            key = baselabel
+            shortlabel = "All addresses"
+        else:
+            key = baselabel + "_" + family
+            search = dict(search, family=family.lower())
+            shortlabel = family
+
+        if lookup:
+            streams = self.streammanager.find_streams(search)
+            if streams is None:
+                log("Failed to find streams for label %s, %s" % \
+                        (key, self.collection_name))
+                return None
+        else:
+            streams = []
+
+        return {
+            'labelstring': key,
+            'streams': streams,
+            'shortlabel': shortlabel
+        }
+
     def _apply_group_regex(self, regex, description):
         """
         Attempts to use a regular expression to deconstruct a group
         description.
 
         Parameters:
-          regex -- the regular expression to apply to the description
+          regex -- the regular expression to apply to the description,
+                   either as a string or a precompiled pattern
           description -- the group description string
 
         Returns:
@@ -1231,4 +1347,29 @@ class Collection(object):
 
         return parts
 
+    def _match_group_regex(self, regex, description):
+        """
+        Matches a group description against a precompiled regular
+        expression. Results are cached, as the same descriptions get
+        parsed many times while building matrices and graphs.
+
+        Parameters:
+          regex -- the precompiled regular expression to apply
+          description -- the group description string
+
+        Returns:
+          A new dictionary mapping the named groups in the regular
+          expression to the matched strings. Returns None if the
+          description does not match the regular expression.
+        """
+
+        parts = _cached_group_match(regex, description)
+        if parts is None:
+            log("Group description did not match regex for %s" % \
+                    (self.collection_name))
+            log(description)
+            return None
+
+        return dict(parts)
+
 # vim: set smartindent shiftwidth=4 tabstop=4 softtabstop=4 expandtab :
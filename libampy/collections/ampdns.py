@@ -32,6 +32,10 @@ from operator import itemgetter
 from libnntscclient.logger import log
 from libampy.collection import Collection
 
+GROUP_FORMAT = "FROM %(source)s TO %(destination)s OPTION %(query)s " \
+        "%(query_type)s %(query_class)s %(udp_payload_size)s %(flags)s " \
+        "%(aggregation)s"
+
 class AmpDns(Collection):
 
     def __init__(self, colid, viewmanager, nntscconf):
@@ -254,22 +258,22 @@ class AmpDns(Collection):
         describing the group.
         """
         # Put in a suitable aggregation method if one is not present, i.e.
-        # we are converting a stream into a group
-        if 'aggregation' not in properties:
-            properties['aggregation'] = "FAMILY"
+        # we are converting a stream into a group. This is done on a copy,
+        # the caller's dictionary is theirs.
+        props = dict(properties,
+                aggregation=properties.get('aggregation', "FAMILY"))
 
         # Convert flags into the flag string
-        if 'flags' not in properties:
-            properties['flags'] = self._create_flag_string(properties)
+        if 'flags' not in props:
+            props['flags'] = self._create_flag_string(props)
 
         for prop in self.groupproperties:
-            if prop not in properties:
+            if prop not in props:
                 log("Required group property '%s' not present in %s group" % \
                         (prop, self.collection_name))
                 return None
 
-        return "FROM %s TO %s OPTION %s %s %s %s %s %s" % \
-                tuple([properties[x] for x in self.groupproperties])
+        return GROUP_FORMAT % props
 
     def parse_group_description(self, description):
         """
@@ -96,30 +96,6 @@ class AmpFastping(AmpIcmp):
 
         return label, self.splits[groupparams['aggregation']]
 
-    def _generate_label(self, baselabel, search, family, lookup):
-        if family is None:
-            key = baselabel
-            shortlabel = "All addresses"
-        else:
-            key = baselabel + "_" + family
-            search['family'] = family.lower()
-            shortlabel = family
-
-        if lookup:
-            streams = self.streammanager.find_streams(search)
-            if streams is None:
-                log("Failed to find streams for label %s, %s" % \
-                        (key, self.collection_name))
-                return None
-        else:
-            streams = []
-
-        return {
-            'labelstring': key,
-            'streams': streams,
-            'shortlabel': shortlabel
-        }
-
     def _group_to_search(self, groupparams):
         return {
             'source': groupparams['source'],
@@ -166,7 +142,8 @@ class AmpFastping(AmpIcmp):
         # stream, we need to convert the 'family' into an appropriate
         # aggregation method.
         if 'family' in properties:
-            properties['aggregation'] = properties['family'].upper()
+            properties = dict(properties,
+                    aggregation=properties['family'].upper())
 
         for prop in self.groupproperties:
             if prop not in properties:
@@ -324,10 +301,10 @@ class AmpFastping(AmpIcmp):
     def _matrix_group_streams(self, props, family, groups):
         props['family'] = family
         label = "%s_%s_%s" % (props['source'], props['destination'], family)
-        streams = self.streammanager.find_streams(props)
+        streams = self._find_matrix_streams(props)
 
         if len(streams) > 0:
-            groups.append({'labelstring': label, 'streams': streams})
+            groups.append({'labelstring': label, 'streams': list(streams)})
 
         return len(streams)
 
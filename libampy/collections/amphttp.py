@@ -95,36 +95,39 @@ class AmpHttp(Collection):
         Converts a dictionary of stream or group properties into a string
         describing the group.
         """
+        # Convert the flags on a copy, the caller's dictionary is theirs
+        props = dict(properties)
+
         for prop in self.groupproperties:
-            if prop not in properties:
+            if prop not in props:
                 log("Required group property '%s' not present in %s group" % \
                         (prop, self.collection_name))
                 return None
 
-            if prop == 'persist' and properties[prop] is True:
-                properties[prop] = "PERSIST"
-            elif prop == 'persist' and properties[prop] is False:
-                properties[prop] = "NOPERSIST"
+            if prop == 'persist' and props[prop] is True:
+                props[prop] = "PERSIST"
+            elif prop == 'persist' and props[prop] is False:
+                props[prop] = "NOPERSIST"
 
-            if prop == 'pipelining' and properties[prop] is True:
-                properties[prop] = "PIPELINING"
-            elif prop == 'pipelining' and properties[prop] is False:
-                properties[prop] = "NOPIPELINING"
+            if prop == 'pipelining' and props[prop] is True:
+                props[prop] = "PIPELINING"
+            elif prop == 'pipelining' and props[prop] is False:
+                props[prop] = "NOPIPELINING"
 
-            if prop == 'caching' and properties[prop] is True:
-                properties[prop] = "CACHING"
-            elif prop == 'caching' and properties[prop] is False:
-                properties[prop] = "NOCACHING"
+            if prop == 'caching' and props[prop] is True:
+                props[prop] = "CACHING"
+            elif prop == 'caching' and props[prop] is False:
+                props[prop] = "NOCACHING"
 
         return "FROM %s FETCH %s MC %s %s %s %s %s %s %s" % (
-                    properties['source'], properties['destination'],
-                    properties['max_connections'],
-                    properties['max_connections_per_server'],
-                    properties['persist'],
-                    properties['max_persistent_connections_per_server'],
-                    properties['pipelining'],
-                    properties['pipelining_max_requests'],
-                    properties['caching'])
+                    props['source'], props['destination'],
+                    props['max_connections'],
+                    props['max_connections_per_server'],
+                    props['persist'],
+                    props['max_persistent_connections_per_server'],
+                    props['pipelining'],
+                    props['pipelining_max_requests'],
+                    props['caching'])
 
     def parse_group_description(self, description):
         """
@@ -33,6 +33,8 @@ from libnntscclient.logger import log
 from libampy.collection import Collection
 
 class AmpSip(Collection):
+    dirlabels = {"rx": "Receive", "tx": "Transmit"}
+
     def __init__(self, colid, viewmanager, nntscconf):
         super(AmpSip, self).__init__(colid, viewmanager, nntscconf)
 
@@ -65,9 +67,6 @@ class AmpSip(Collection):
             "proxy": "",
         }
 
-        self.dirlabels = {"rx": "Receive", "tx": "Transmit"}
-
-
     def detail_columns(self, detail):
         if detail == "matrix":
             aggcols = [
@@ -126,28 +125,25 @@ class AmpSip(Collection):
 
 
     def create_group_description(self, properties):
-        if 'direction' not in properties:
-            properties['direction'] = "BOTH"
-        #if 'family' not in properties and 'address' in properties:
-        #    properties['family'] = self._address_to_family(properties['address'])
-        if 'proxy' not in properties:
-            properties['proxy'] = ""
+        # Fill in any defaults on a copy, the caller's dictionary is theirs
+        props = dict(properties,
+                direction=properties.get('direction', "BOTH"),
+                proxy=properties.get('proxy', ""))
+        #if 'family' not in props and 'address' in props:
+        #    props['family'] = self._address_to_family(props['address'])
 
         for prop in self.groupproperties:
-            if prop not in properties:
+            if prop not in props:
                 log("Required group property '%s' not present in %s group" % (
                         prop, self.collection_name))
                 return None
 
-        properties['direction'] = properties['direction'].upper()
-        properties['aggregation'] = properties['aggregation'].upper()
-
         return "FROM %s TO %s DSCP %s VIA %s FILE %s DURATION %d REPEAT %s DIRECTION %s %s"\
-                % (properties['source'], properties['destination'],
-                   properties['dscp'], properties['proxy'],
-                   properties['filename'], properties['max_duration'],
-                   str(properties['repeat']).upper(),
-                   properties['direction'], properties['aggregation'])
+                % (props['source'], props['destination'],
+                   props['dscp'], props['proxy'],
+                   props['filename'], props['max_duration'],
+                   str(props['repeat']).upper(),
+                   props['direction'].upper(), props['aggregation'].upper())
 
 
     def parse_group_description(self, description):
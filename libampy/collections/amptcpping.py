@@ -48,7 +48,8 @@ class AmpTcpping(AmpIcmp):
 
     def create_group_description(self, properties):
         if 'family' in properties:
-            properties['aggregation'] = properties['family'].upper()
+            properties = dict(properties,
+                    aggregation=properties['family'].upper())
 
         for prop in self.groupproperties:
             if prop not in properties:
@@ -33,6 +33,8 @@ from libnntscclient.logger import log
 from libampy.collection import Collection
 
 class AmpThroughput(Collection):
+    dirlabels = {"in": "Download", "out": "Upload"}
+
     def __init__(self, colid, viewmanager, nntscconf):
         super(AmpThroughput, self).__init__(colid, viewmanager, nntscconf)
 
@@ -49,8 +51,6 @@ class AmpThroughput(Collection):
         self.default_writesize = 131072
         self.default_protocol = "default"
 
-        self.dirlabels = {"in": "Download", "out": "Upload"}
-
     def detail_columns(self, detail):
         aggfuncs = ["sum", "sum", "sum", "stddev", "count"]
         aggcols = ["bytes", "packets", "runtime", "rate", "unused"]
@@ -95,26 +95,23 @@ class AmpThroughput(Collection):
         else:
             reuse = "F"
 
-        if 'direction' not in properties:
-            properties['direction'] = "BOTH"
-        if 'family' not in properties and 'address' in properties:
-            properties['family'] = \
-                    self._address_to_family(properties['address'])
+        # Fill in any defaults on a copy, the caller's dictionary is theirs
+        props = dict(properties,
+                direction=properties.get('direction', "BOTH"))
+        if 'family' not in props and 'address' in props:
+            props['family'] = self._address_to_family(props['address'])
 
         for prop in self.groupproperties:
-            if prop not in properties:
+            if prop not in props:
                 log("Required group property '%s' not present in %s group" % \
                         (prop, self.collection_name))
                 return None
 
-        properties['direction'] = properties['direction'].upper()
-        properties['family'] = properties['family'].upper()
-
         return "FROM %s TO %s DURATION %s WRITESIZE %s %s DIRECTION %s FAMILY %s PROTOCOL %s" \
-                % (properties['source'], properties['destination'],
-                   properties['duration'], properties['writesize'], reuse,
-                   properties['direction'], properties['family'],
-                   properties['protocol'])
+                % (props['source'], props['destination'],
+                   props['duration'], props['writesize'], reuse,
+                   props['direction'].upper(), props['family'].upper(),
+                   props['protocol'])
 
     def get_legend_label(self, description):
         groupparams = self.parse_group_description(description)
@@ -410,7 +407,7 @@ class AmpThroughput(Collection):
         baseprops['family'] = family
         label = "%s_%s_%s_%s_%s" % (baseprops['source'], baseprops['destination'],
                 baseprops['protocol'], direction, family)
-        streams = self.streammanager.find_streams(baseprops)
+        streams = self._find_matrix_streams(baseprops)
 
         if len(streams) > 0:
             groups.append({
@@ -31,6 +31,23 @@
 from libnntscclient.logger import log
 from libampy.collections.ampicmp import AmpIcmp
 
+IPPATH_DETAILS = frozenset(["ippaths", "raw"])
+UNFORMATTED_DETAILS = frozenset(["matrix", "basic", "raw", "tooltiptext",
+        "spark"])
+SUMMARY_DETAILS = frozenset(["matrix", "basic", "tooltiptext", "spark"])
+HOPS_DETAILS = frozenset(["hops-full", "hops-summary"])
+# Details where AS traceroute fetches the response count alongside the path
+AS_RESPONSE_DETAILS = frozenset(["matrix", "basic", "raw", "tooltiptext",
+        "spark"])
+AS_EXTRA_BLOCK_DETAILS = frozenset(["hops-full", "full"])
+IP_FAMILIES = frozenset(["IPV4", "IPV6"])
+
+SPECIAL_HOPS = {
+    "-2": ("RFC 1918", 0, "RFC 1918"),
+    "-1": ("No response", 0, "No response"),
+    "0": ("Unknown", 0, "Unknown"),
+}
+
 class AmpTraceroute(AmpIcmp):
     def __init__(self, colid, viewmanager, nntscconf, asnmanager):
         super(AmpTraceroute, self).__init__(colid, viewmanager, nntscconf)
@@ -47,12 +64,12 @@ class AmpTraceroute(AmpIcmp):
         self.asnmanager = asnmanager
 
     def group_columns(self, detail):
-        if detail in ["ippaths", "raw"]:
+        if detail in IPPATH_DETAILS:
             return ['aspath', 'path']
         return []
 
     def detail_columns(self, detail):
-        if detail in ["ippaths", "raw"]:
+        if detail in IPPATH_DETAILS:
             aggfuncs = ["most", "most", "count", "most", "most"]
             aggcols = ["error_type", "error_code", "path", "path_id", "length"]
         elif detail == "ippaths-summary":
@@ -84,11 +101,14 @@ class AmpTraceroute(AmpIcmp):
                     labels, start, end, detail, binsize)
 
         uncached = {}
+        cachelabels = {}
         paths = {}
+        suffix = "_ippaths_" + self.collection_name
+        maxlabellen = 128 - len(suffix)
 
         for lab in labels:
-            cachelabel = lab['labelstring'] + "_ippaths_" + self.collection_name
-            if len(cachelabel) > 128:
+            cachelabel = lab['labelstring'] + suffix
+            if len(lab['labelstring']) > maxlabellen:
                 log("Warning: ippath cache label %s is too long" % (cachelabel))
 
             cachehit = cache.search_ippaths(cachelabel, start, end)
@@ -100,39 +120,87 @@ class AmpTraceroute(AmpIcmp):
                 paths[lab['labelstring']] = []
             else:
                 uncached[lab['labelstring']] = lab['streams']
+                cachelabels[lab['labelstring']] = cachelabel
 
         if len(uncached) > 0:
             result = self._fetch_history(uncached, start, end, end-start,
                     detail)
 
+            completed = {}
             for label, queryresult in result.items():
                 if len(queryresult['timedout']) != 0:
                     paths[label] = []
-                    continue
+                else:
+                    completed[label] = queryresult['data']
 
-                formatted = self.format_list_data(queryresult['data'], detail)
+            # Format the paths for all of the labels together, so that we
+            # only need to look up the AS names once
+            formattedlists = self._format_data_lists(
+                    list(completed.values()), detail)
 
-                cachelabel = label + "_ippaths_" + self.collection_name
-                if len(cachelabel) > 128:
-                    log("Warning: ippath cache label %s is too long" % \
-                            (cachelabel))
-                cache.store_ippaths(cachelabel, start, end, formatted)
+            for label, formatted in zip(completed.keys(), formattedlists):
+                cache.store_ippaths(cachelabels[label], start, end, formatted)
                 paths[label] = formatted
 
         return paths
 
     def format_list_data(self, datalist, detail):
-        reslist = []
-        for data in datalist:
-            reslist.append(self.format_single_data(data, detail))
-        return reslist
+        return self._format_data_lists([datalist], detail)[0]
+
+    def _format_data_lists(self, datalists, detail):
+        # None of the rows need formatting at these detail levels, so
+        # don't bother checking each one individually
+        if detail in UNFORMATTED_DETAILS:
+            return datalists
+
+        # Parse every row first so that we only have to look up the names
+        # for all of the ASNs in the lists once, rather than once per row.
+        # Many rows will have exactly the same AS path, so only parse each
+        # distinct path once.
+        parsed = []
+        seen = {}
+        toquery = set()
+        for datalist in datalists:
+            listparsed = []
+            for data in datalist:
+                aspath = None
+                if data.get('aspath') is not None:
+                    key = tuple(data['aspath'])
+                    aspath = seen.get(key)
+                    if aspath is None:
+                        aspath = self._parse_aspath(data, detail)
+                        seen[key] = aspath
+                        toquery.update(aspath[2])
+                listparsed.append(aspath)
+            parsed.append(listparsed)
+
+        queried = self._query_asnames(toquery)
+
+        reslists = []
+        for datalist, listparsed in zip(datalists, parsed):
+            reslist = []
+            for data, aspath in zip(datalist, listparsed):
+                if aspath is not None:
+                    data = self._apply_asnames(data, list(aspath[0]),
+                            aspath[1], queried)
+                reslist.append(data)
+            reslists.append(reslist)
+        return reslists
 
     def format_single_data(self, data, detail):
-        if 'aspath' not in data or data['aspath'] is None:
+        aspath = self._parse_aspath(data, detail)
+        if aspath is None:
             return data
 
-        if detail in ['matrix', 'basic', 'raw', 'tooltiptext', 'spark']:
-            return data
+        queried = self._query_asnames(aspath[2])
+        return self._apply_asnames(data, aspath[0], aspath[1], queried)
+
+    def _parse_aspath(self, data, detail):
+        if 'aspath' not in data or data['aspath'] is None:
+            return None
+
+        if detail in UNFORMATTED_DETAILS:
+            return None
 
         pathlen = 0
         aspath = []
@@ -143,42 +211,43 @@ class AmpTraceroute(AmpIcmp):
             if len(asnsplit) != 2:
                 continue
 
-            if asnsplit[1] == "-2":
-                aslabel = asname = "RFC 1918"
-            elif asnsplit[1] == "-1":
-                aslabel = asname = "No response"
-            elif asnsplit[1] == "0":
-                aslabel = asname = "Unknown"
-            else:
-                aslabel = "AS" + asnsplit[1]
-                asname = None
-                toquery.add(aslabel)
-
             repeats = int(asnsplit[0])
             pathlen += repeats
 
-            for i in range(0, repeats):
-                aspath.append([asname, 0, aslabel])
+            # Hops that don't belong to a real AS never have their name
+            # changed, so they can all share the same row
+            special = SPECIAL_HOPS.get(asnsplit[1])
+            if special is not None:
+                aspath.extend([special] * repeats)
+                continue
 
-        data['aspathlen'] = pathlen
+            aslabel = "AS" + asnsplit[1]
+            toquery.add(aslabel)
+
+            aspath.extend([None, 0, aslabel] for _ in range(repeats))
 
+        return aspath, pathlen, toquery
+
+    def _query_asnames(self, toquery):
         if len(toquery) == 0:
-            data['aspath'] = aspath
-            return data
+            return {}
 
         queried = self.asnmanager.queryASNames(toquery)
         if queried is None:
             log("Unable to query AS names")
-            data['aspath'] = aspath
-            return data
+        return queried
 
-        for asp in aspath:
-            if asp[0] != None:
-                continue
-            if asp[2] not in queried:
-                asp[0] = asp[2]
-            else:
-                asp[0] = queried[asp[2]]
+    def _apply_asnames(self, data, aspath, pathlen, queried):
+        data['aspathlen'] = pathlen
+
+        if queried is not None:
+            for asp in aspath:
+                if asp[0] != None:
+                    continue
+                if asp[2] not in queried:
+                    asp[0] = asp[2]
+                else:
+                    asp[0] = queried[asp[2]]
 
         data['aspath'] = aspath
         return data
@@ -187,8 +256,7 @@ class AmpTraceroute(AmpIcmp):
         return 1
 
     def translate_group(self, groupprops):
-        if 'aggregation' not in groupprops or groupprops['aggregation'] \
-                    not in ["IPV4", "IPV6"]:
+        if groupprops.get('aggregation') not in IP_FAMILIES:
             return None
         return super(AmpTraceroute, self).translate_group(groupprops)
 
@@ -225,7 +293,7 @@ class AmpTraceroutePathlen(AmpTraceroute):
         if detail == "raw":
             aggfuncs = []
             aggcols = ['path_length', 'unused']
-        elif detail in ["matrix", "basic", "tooltiptext", "spark"]:
+        elif detail in SUMMARY_DETAILS:
             aggfuncs = ['mode']
             aggcols = ['path_length']
         else:
@@ -254,10 +322,10 @@ class AmpAsTraceroute(AmpTraceroute):
         return []
 
     def detail_columns(self, detail):
-        if detail in ["matrix", "basic", "tooltiptext", "spark", "raw"]:
+        if detail in AS_RESPONSE_DETAILS:
             aggfuncs = ["avg", "most_array"]
             aggcols = ["responses", "aspath"]
-        elif detail == "hops-full" or detail == "hops-summary":
+        elif detail in HOPS_DETAILS:
             aggfuncs = ["most_array"]
             aggcols = ["aspath"]
         else:
@@ -266,13 +334,12 @@ class AmpAsTraceroute(AmpTraceroute):
         return aggcols, aggfuncs
 
     def extra_blocks(self, detail):
-        if detail == "hops-full" or detail == "full":
+        if detail in AS_EXTRA_BLOCK_DETAILS:
             return 2
         return 0
 
     def translate_group(self, groupprops):
-        if 'aggregation' not in groupprops or groupprops['aggregation'] \
-                    not in ["IPV4", "IPV6"]:
+        if groupprops.get('aggregation') not in IP_FAMILIES:
             return None
         return super(AmpAsTraceroute, self).translate_group(groupprops)
 
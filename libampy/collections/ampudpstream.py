@@ -28,10 +28,83 @@
 # Please report any bugs, questions or comments to contact@wand.net.nz
 #
 
+import re
+from sys import intern
+from operator import itemgetter
 from libnntscclient.logger import log
+from libampy.collection import Collection
 from libampy.collections.ampthroughput import AmpThroughput
 
+GROUP_REGEX = re.compile(
+    "FROM (?P<source>[.a-zA-Z0-9_-]+) "
+    "TO (?P<destination>[.a-zA-Z0-9_:-]+) "
+    "DSCP (?P<dscp>[a-zA-Z0-9-]+) "
+    "SIZE (?P<size>[0-9-]+) "
+    "SPACING (?P<spacing>[0-9-]+) "
+    "COUNT (?P<count>[0-9-]+) "
+    "DIRECTION (?P<direction>[A-Z]+) "
+    "(?P<family>[A-Z0-9]+)"
+)
+
+GROUP_FORMAT = "FROM %(source)s TO %(destination)s DSCP %(dscp)s " \
+        "SIZE %(packet_size)s SPACING %(packet_spacing)s " \
+        "COUNT %(packet_count)s DIRECTION %(direction)s %(family)s"
+
+EXTRA_BLOCK_DETAILS = frozenset(["jitter", "full"])
+VALID_DIRECTIONS = frozenset(["IN", "OUT", "BOTH"])
+VALID_FAMILIES = frozenset(["IPV4", "IPV6", "FAMILY", "NONE"])
+
+LEGEND_FORMAT = "%(source)s : %(destination)s, %(packet_count)s " \
+        "%(packet_size)sB pkts, %(packet_spacing)s usec apart (DSCP %(dscp)s)"
+
+FAMILY_LABELS = {"IPV4": "IPv4", "IPV6": "IPv6", "FAMILY": "IPv4/IPv6"}
+DIRECTION_LABELS = {"BOTH": "", "IN": " Inward"}
+
+# Columns to query and how to aggregate them for each level of detail.
+# These lists are shared by every query, so must not be modified.
+JITTER_COLUMNS = [
+    "min_jitter", "jitter_percentile_10",
+    "jitter_percentile_20",
+    "jitter_percentile_30",
+    "jitter_percentile_40",
+    "jitter_percentile_50",
+    "jitter_percentile_60",
+    "jitter_percentile_70",
+    "jitter_percentile_80",
+    "jitter_percentile_90",
+    "jitter_percentile_100",
+    "mean_rtt", "packets_sent", "packets_recvd",
+]
+JITTER_AGGREGATORS = ['mean'] * (len(JITTER_COLUMNS) - 2) + ['sum', 'sum']
+SUMMARY_COLUMNS = (
+    ['packets_sent', 'packets_recvd', 'mean_rtt'],
+    ['sum', 'sum', 'avg'],
+)
+
+DETAIL_COLUMNS = {
+    "jitter": (JITTER_COLUMNS, JITTER_AGGREGATORS),
+    "jitter-summary": (JITTER_COLUMNS, JITTER_AGGREGATORS),
+    # if the other fields are all empty we need a valid field that
+    # will always have something in it
+    "raw": (JITTER_COLUMNS + ["unused"], JITTER_AGGREGATORS),
+    "matrix": (
+        ['packets_sent', 'packets_recvd', 'mean_rtt', 'mean_rtt',
+                'mean_rtt'],
+        ['sum', 'sum', 'avg', 'stddev', 'count'],
+    ),
+    "basic": SUMMARY_COLUMNS,
+    "tooltiptext": SUMMARY_COLUMNS,
+    "spark": SUMMARY_COLUMNS,
+}
+
+DEFAULT_DETAIL_COLUMNS = (
+    ["mean_jitter", "mean_rtt", "packets_recvd", "packets_sent"],
+    ["mean", "mean", "sum", "sum"],
+)
+
 class AmpUdpstream(AmpThroughput):
+    dirlabels = {"in": "Inward", "out": "Outward"}
+
     def __init__(self, colid, viewmanager, nntscconf):
         super(AmpUdpstream, self).__init__(colid, viewmanager, nntscconf)
 
@@ -40,6 +113,7 @@ class AmpUdpstream(AmpThroughput):
             'packet_count', 'direction', 'family'
             ]
         self.groupproperties = self.streamproperties
+        self.requiredproperties = frozenset(self.groupproperties)
         self.integerproperties = [
             'packet_size', 'packet_spacing', 'packet_count'
         ]
@@ -50,91 +124,36 @@ class AmpUdpstream(AmpThroughput):
         self.default_spacing = 20000
         self.default_dscp = "Default"
 
-        self.dirlabels = {"in": "Inward", "out": "Outward"}
-
     def extra_blocks(self, detail):
-        if detail in ["jitter", "full"]:
+        if detail in EXTRA_BLOCK_DETAILS:
             return 2
         return 0
 
     def detail_columns(self, detail):
-        if detail in ["jitter", "jitter-summary", "raw"]:
-            aggcols = [
-                "min_jitter", "jitter_percentile_10",
-                "jitter_percentile_20",
-                "jitter_percentile_30",
-                "jitter_percentile_40",
-                "jitter_percentile_50",
-                "jitter_percentile_60",
-                "jitter_percentile_70",
-                "jitter_percentile_80",
-                "jitter_percentile_90",
-                "jitter_percentile_100",
-                "mean_rtt", "packets_sent", "packets_recvd",
-            ]
-            aggmethods = ['mean'] * (len(aggcols) - 2) + ['sum', 'sum']
-            if detail == "raw":
-                # if the other fields are all empty we need a valid field that
-                # will always have something in it
-                aggcols.append("unused")
-            return (aggcols, aggmethods)
-
-        if detail == "matrix":
-            aggcols = [
-                'packets_sent', 'packets_recvd', 'mean_rtt', 'mean_rtt',
-                'mean_rtt'
-            ]
-            aggmethods = ['sum', 'sum', 'avg', 'stddev', 'count']
-            return (aggcols, aggmethods)
-
-        if detail in ['basic', 'tooltiptext', 'spark']:
-            aggcols = ['packets_sent', 'packets_recvd', 'mean_rtt']
-            aggmethods = ['sum', 'sum', 'avg']
-            return (aggcols, aggmethods)
-
-        return (
-            ["mean_jitter", "mean_rtt", "packets_recvd", "packets_sent"],
-            ["mean", "mean", "sum", "sum"],
-        )
+        return DETAIL_COLUMNS.get(detail, DEFAULT_DETAIL_COLUMNS)
 
     def calculate_binsize(self, start, end, detail):
-        minbin = int(((end - start)) / 200)
-
-        if minbin <= 300:
-            binsize = 300
-        elif minbin <= 600:
-            binsize = 600
-        elif minbin <= 1200:
-            binsize = 1200
-        elif minbin <= 2400:
-            binsize = 2400
-        elif minbin <= 4800:
-            binsize = 4800
-        else:
-            binsize = 14400
-        return binsize
+        # udpstream tests run far more often than throughput tests, so
+        # use the default binsizes rather than the throughput ones
+        return Collection.calculate_binsize(self, start, end, detail)
 
     def create_group_description(self, properties):
-        if 'direction' not in properties:
-            properties['direction'] = "BOTH"
-        if 'family' not in properties and 'address' in properties:
-            properties['family'] = \
-                    self._address_to_family(properties['address'])
-
-        for prop in self.groupproperties:
-            if prop not in properties:
-                log("Required group property '%s' not present in %s group" % \
-                        (prop, self.collection_name))
-                return None
-
-        properties['direction'] = properties['direction'].upper()
-        properties['family'] = properties['family'].upper()
-
-        return "FROM %s TO %s DSCP %s SIZE %s SPACING %s COUNT %s DIRECTION %s %s" \
-                % (properties['source'], properties['destination'],
-                   properties['dscp'], properties['packet_size'],
-                   properties['packet_spacing'], properties['packet_count'],
-                   properties['direction'], properties['family'])
+        # Fill in any defaults on a copy, the caller's dictionary is theirs
+        props = dict(properties,
+                direction=properties.get('direction', "BOTH"))
+        if 'family' not in props and 'address' in props:
+            props['family'] = self._address_to_family(props['address'])
+
+        missing = self.requiredproperties.difference(props)
+        if missing:
+            prop = [p for p in self.groupproperties if p in missing][0]
+            log("Required group property '%s' not present in %s group" % \
+                    (prop, self.collection_name))
+            return None
+
+        return GROUP_FORMAT % dict(props,
+                direction=props['direction'].upper(),
+                family=props['family'].upper())
 
     def get_legend_label(self, description):
         groupparams = self.parse_group_description(description)
@@ -142,61 +161,37 @@ class AmpUdpstream(AmpThroughput):
             log("Failed to parse group description to generate %s legend label" % (self.collection_name))
             return None, ""
 
-        if groupparams['family'] == "IPV4":
-            family = "IPv4"
-        elif groupparams['family'] == "IPV6":
-            family = "IPv6"
-        elif groupparams['family'] == "FAMILY":
-            family = "IPv4/IPv6"
-        else:
-            family = ""
-
-        if groupparams['direction'] == "BOTH":
-            dirstr = ""
-        elif groupparams['direction'] == "IN":
-            dirstr = " Inward"
-        else:
-            dirstr = " Outward"
+        family = FAMILY_LABELS.get(groupparams['family'], "")
+        dirstr = DIRECTION_LABELS.get(groupparams['direction'], " Outward")
 
-        label = "%s : %s, %s %sB pkts, %s usec apart (DSCP %s)" % (
-                groupparams['source'], groupparams['destination'],
-                groupparams['packet_count'], groupparams['packet_size'],
-                groupparams['packet_spacing'], groupparams['dscp'])
-        return label, "%s%s" % (family, dirstr)
+        return LEGEND_FORMAT % groupparams, family + dirstr
 
     def parse_group_description(self, description):
-        regex = "FROM (?P<source>[.a-zA-Z0-9_-]+) "
-        regex += "TO (?P<destination>[.a-zA-Z0-9_:-]+) "
-        regex += "DSCP (?P<dscp>[a-zA-Z0-9-]+) "
-        regex += "SIZE (?P<size>[0-9-]+) "
-        regex += "SPACING (?P<spacing>[0-9-]+) "
-        regex += "COUNT (?P<count>[0-9-]+) "
-        regex += "DIRECTION (?P<direction>[A-Z]+) "
-        regex += "(?P<family>[A-Z0-9]+)"
-
-        parts = self._apply_group_regex(regex, description)
+        parts = self._match_group_regex(GROUP_REGEX, description)
         if parts is None:
             return None
 
-        if parts.group('direction') not in ['IN', 'OUT', 'BOTH']:
+        if parts['direction'] not in VALID_DIRECTIONS:
             log("%s is not a valid direction for a %s group" % \
-                    (parts.group('direction'), self.collection_name))
+                    (parts['direction'], self.collection_name))
             return None
 
-        if parts.group('family') not in ['IPV4', 'IPV6', 'FAMILY', 'NONE']:
+        if parts['family'] not in VALID_FAMILIES:
             log("%s is not a valid address family for a %s group" % \
-                    (parts.group('family'), self.collection_name))
+                    (parts['family'], self.collection_name))
             return None
 
+        # family, direction and dscp only ever take a handful of values, so
+        # intern them to make later comparisons against constants cheap
         keydict = {
-            'source': parts.group('source'),
-            'destination': parts.group("destination"),
-            'family': parts.group("family"),
-            'direction': parts.group("direction"),
-            'packet_size': int(parts.group('size')),
-            'packet_count': int(parts.group('count')),
-            'packet_spacing': int(parts.group('spacing')),
-            'dscp': parts.group('dscp'),
+            'source': parts['source'],
+            'destination': parts["destination"],
+            'family': intern(parts["family"]),
+            'direction': intern(parts["direction"]),
+            'packet_size': int(parts['size']),
+            'packet_count': int(parts['count']),
+            'packet_spacing': int(parts['spacing']),
+            'dscp': intern(parts['dscp']),
         }
 
         return keydict
@@ -226,8 +221,9 @@ class AmpUdpstream(AmpThroughput):
             views[(source, dest)] = -1
             return
 
-        poss = [c['text'] for c in counts['items']]
-        baseprop['packet_count'] = max(poss)
+        # Compare the packet counts as integers, otherwise a count of 9
+        # would be treated as larger than a count of 10
+        baseprop['packet_count'] = max(int(c['text']) for c in counts['items'])
 
         ipv4 = self._matrix_group_streams(baseprop, "out", "ipv4", groups)
         ipv6 = self._matrix_group_streams(baseprop, "out", "ipv6", groups)
@@ -261,22 +257,22 @@ class AmpUdpstream(AmpThroughput):
 
     def _matrix_group_streams(self, baseprops, direction, family, groups):
 
-        baseprops['direction'] = direction
-        baseprops['family'] = family
-        label = "%s_%s_%s_%s" % (baseprops['source'], baseprops['destination'],
-                direction, family)
-        streams = self.streammanager.find_streams(baseprops)
+        # Search using a copy so the caller's properties are left untouched
+        search = dict(baseprops, direction=direction, family=family)
+        label = "_".join([baseprops['source'], baseprops['destination'],
+                direction, family])
+        streams = self._find_matrix_streams(search)
 
         if len(streams) > 0:
             groups.append({'labelstring': label,
-                    'streams': [x[0] for x in streams]})
+                    'streams': list(map(itemgetter(0), streams))})
         return len(streams)
 
     def _add_matrix_group(self, props, split, family, viewmanager, viewstyle):
         cellgroup = self.create_group_from_list(
-            [props['source'], props['destination'],
+            (props['source'], props['destination'],
             props['dscp'], props['packet_size'], props['packet_spacing'],
-            props['packet_count'], split, family.upper()]
+            props['packet_count'], split, family.upper())
         )
         if cellgroup is None:
             log("Failed to create %s group for %s matrix cell" % \
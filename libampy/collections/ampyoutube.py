@@ -28,9 +28,68 @@
 # Please report any bugs, questions or comments to contact@wand.net.nz
 #
 
+import re
+from bisect import bisect_right
 from libnntscclient.logger import log
 from libampy.collection import Collection
 
+GROUP_REGEX = re.compile(
+    "FROM (?P<source>[.a-zA-Z0-9_-]+) "
+    r"FETCH (?P<destination>[\S]+) "
+    "(?P<quality>[0-9]+)"
+)
+
+# Use the smallest of these binsizes that gives fewer than 200 bins over
+# the period being graphed
+BINSIZES = (900, 900 * 4, 900 * 12, 900 * 24)
+BINSIZE_THRESHOLDS = tuple(b * 200 for b in BINSIZES[:-1])
+
+# Columns to query and how to aggregate them for each level of detail.
+# These lists are shared by every query, so must not be modified.
+SUMMARY_COLUMNS = (
+    ['total_time', 'total_time',
+            'pre_time', 'pre_time',
+            'initial_buffering', 'initial_buffering',
+            'stall_time', 'stall_time',
+            'stall_count', 'stall_count',
+    ],
+    ['avg', 'stddev', 'avg', 'stddev', 'avg', 'stddev',
+            'avg', 'stddev', 'avg', 'stddev'],
+)
+# XXX this needs to actually come from the event timeline list
+RAINBOW_COLUMNS = (
+    ["pre_time", "initial_buffering", "playing_time", "stall_time",
+            "total_time"],
+    ["avg", "avg", "avg", "avg", "avg"],
+)
+
+DETAIL_COLUMNS = {
+    "matrix": SUMMARY_COLUMNS,
+    "basic": SUMMARY_COLUMNS,
+    "spark": SUMMARY_COLUMNS,
+    "tooltiptext": SUMMARY_COLUMNS,
+    "rainbow": RAINBOW_COLUMNS,
+    "rainbow-summary": RAINBOW_COLUMNS,
+    "raw": RAINBOW_COLUMNS,
+}
+
+DEFAULT_DETAIL_COLUMNS = (
+    ['total_time', 'total_time'],
+    ['avg', 'stddev'],
+)
+
+QUALITY_LABELS = {
+    1: "default",
+    2: "small",
+    3: "medium",
+    4: "large",
+    5: "hd720",
+    6: "hd1080",
+    7: "hd1440",
+    8: "hd2160",
+    9: "highres",
+}
+
 class AmpYoutube(Collection):
     def __init__(self, colid, viewmanager, nntscconf):
         super(AmpYoutube, self).__init__(colid, viewmanager, nntscconf)
@@ -40,6 +99,7 @@ class AmpYoutube(Collection):
         self.groupproperties = [
             'source', 'destination', 'quality'
         ]
+        self.requiredproperties = frozenset(self.groupproperties)
         # XXX is quality best as an integer or a string?
         # XXX desired quality vs actual quality
         self.integerproperties = [
@@ -60,53 +120,27 @@ class AmpYoutube(Collection):
         Determines which data table columns should be queried and how they
         should be aggregated, given the amount of detail required by the user.
         """
-        if detail in ['matrix', 'basic', 'spark', 'tooltiptext']:
-            aggs = ['avg', 'stddev', 'avg', 'stddev', 'avg', 'stddev',
-                    'avg', 'stddev', 'avg', 'stddev']
-            cols = ['total_time', 'total_time',
-                    'pre_time', 'pre_time',
-                    'initial_buffering', 'initial_buffering',
-                    'stall_time', 'stall_time',
-                    'stall_count', 'stall_count',
-            ]
-        elif detail in ["rainbow", "rainbow-summary", "raw"]:
-            # XXX this needs to actually come from the event timeline list
-            aggs = ["avg", "avg", "avg", "avg", "avg"]
-            cols = ["pre_time", "initial_buffering", "playing_time",
-                    "stall_time", "total_time"]
-        else:
-            # XXX what other detail types get used?
-            aggs = ['avg', 'stddev']
-            cols = ['total_time', 'total_time']
-
-        return cols, aggs
+        # XXX what other detail types get used?
+        return DETAIL_COLUMNS.get(detail, DEFAULT_DETAIL_COLUMNS)
 
     def calculate_binsize(self, start, end, detail):
         """
         Determines an appropriate binsize for a graph covering the
         specified time period.
         """
-        if (end - start) / 900 < 200:
-            return 900
-
-        if (end - start) / (900 * 4) < 200:
-            return (900 * 4)
-
-        if (end - start) / (900 * 12) < 200:
-            return (900 * 12)
-
-        return (900 * 24)
+        return BINSIZES[bisect_right(BINSIZE_THRESHOLDS, end - start)]
 
     def create_group_description(self, properties):
         """
         Converts a dictionary of stream or group properties into a string
         describing the group.
         """
-        for prop in self.groupproperties:
-            if prop not in properties:
-                log("Required group property '%s' not present in %s group" % \
-                        (prop, self.collection_name))
-                return None
+        missing = self.requiredproperties.difference(properties)
+        if missing:
+            prop = [p for p in self.groupproperties if p in missing][0]
+            log("Required group property '%s' not present in %s group" % \
+                    (prop, self.collection_name))
+            return None
 
         return "FROM %s FETCH %s %s" % (
                     properties['source'], properties['destination'],
@@ -117,44 +151,20 @@ class AmpYoutube(Collection):
         Converts a group description string into a dictionary mapping
         group properties to their values.
         """
-        regex = "FROM (?P<source>[.a-zA-Z0-9_-]+) "
-        regex += "FETCH (?P<destination>[\S]+) "
-        regex += "(?P<quality>[0-9]+)"
-
-        parts = self._apply_group_regex(regex, description)
+        parts = self._match_group_regex(GROUP_REGEX, description)
         if parts is None:
             return None
 
         keydict = {
-            'source': parts.group('source'),
-            'destination': parts.group('destination'),
-            'quality': int(parts.group('quality')),
+            'source': parts['source'],
+            'destination': parts['destination'],
+            'quality': int(parts['quality']),
         }
 
         return keydict
 
     def _get_quality_label(self, quality):
-        if quality == 1:
-            label = "default"
-        elif quality == 2:
-            label = "small"
-        elif quality == 3:
-            label = "medium"
-        elif quality == 4:
-            label = "large"
-        elif quality == 5:
-            label = "hd720"
-        elif quality == 6:
-            label = "hd1080"
-        elif quality == 7:
-            label = "hd1440"
-        elif quality == 8:
-            label = "hd2160"
-        elif quality == 9:
-            label = "highres"
-        else:
-            label = "unknown"
-        return label
+        return QUALITY_LABELS.get(quality, "unknown")
 
     def get_legend_label(self, description):
         """
@@ -186,10 +196,6 @@ class AmpYoutube(Collection):
 
         baselabel = 'group_%s' % (groupid)
 
-        for key, value in groupparams.items():
-            if key in self.integerproperties:
-                groupparams[key] = int(value)
-
         if lookup:
             streams = self.streammanager.find_streams(groupparams)
             if streams is None:
@@ -225,12 +231,22 @@ class AmpYoutube(Collection):
 
         groups.append({'labelstring': label, 'streams': streams})
 
+        # Streams with the same group properties would produce identical
+        # groups, so only create one group for each set of properties
         cellgroups = []
+        seen = set()
+        findprops = self.streammanager.find_stream_properties
+        creategroup = self.create_group_from_list
+        groupproperties = self.groupproperties
         for stream in streams:
-            props = self.streammanager.find_stream_properties(stream)
+            props = findprops(stream)
+
+            proptuple = tuple(props[x] for x in groupproperties)
+            if proptuple in seen:
+                continue
+            seen.add(proptuple)
 
-            proplist = [props[x] for x in self.groupproperties]
-            cellgroup = self.create_group_from_list(proplist)
+            cellgroup = creategroup(list(proptuple))
 
             if cellgroup is None:
                 log("Failed to create group for %s matrix cell" % \
@@ -28,11 +28,48 @@
 # Please report any bugs, questions or comments to contact@wand.net.nz
 #
 
+import re
+from sys import intern
 from libnntscclient.logger import *
 from libampy.collection import Collection
-from operator import itemgetter
+
+GROUP_REGEX = re.compile(
+    "SOURCE (?P<source>[.a-zA-Z0-9_-]+) "
+    r"TARGET (?P<host>\S+) "
+    "(?P<split>[A-Z0-9]+)"
+)
+
+MATRIX_COLUMNS = (
+    ["median", "median", "median", "loss", "pingsent", "lossrate"],
+    ["avg", "stddev", "count", "sum", "sum", "stddev"],
+)
+SUMMARY_COLUMNS = (
+    ["loss", "pingsent", "median"],
+    ["sum", "sum", "avg"],
+)
+
+DETAIL_COLUMNS = {
+    "matrix": MATRIX_COLUMNS,
+    "basic": SUMMARY_COLUMNS,
+    "spark": SUMMARY_COLUMNS,
+    "tooltiptext": SUMMARY_COLUMNS,
+}
+
+DEFAULT_DETAIL_COLUMNS = (
+    ["median", "pings", "loss", "pingsent"],
+    ["avg", "smokearray", "sum", "sum"],
+)
+
+IPV4_SPLITS = frozenset(["IPV4", "FAMILY"])
+IPV6_SPLITS = frozenset(["IPV6", "FAMILY"])
 
 class RRDSmokeping(Collection):
+    splits = {
+        "IPV4": "IPv4",
+        "IPV6": "IPv6",
+        "FAMILY": "IPv4/IPv6"
+    }
+
     def __init__(self, colid, viewmanager, nntscconf):
         super(RRDSmokeping, self).__init__(colid, viewmanager, nntscconf)
 
@@ -41,26 +78,10 @@ class RRDSmokeping(Collection):
         self.collection_name = "rrd-smokeping"
         self.viewstyle = self.collection_name
 
-        self.splits = {
-            "IPV4": "IPv4",
-            "IPV6": "IPv6",
-            "FAMILY": "IPv4/IPv6"
-        }
-
         self.default_aggregation = "FAMILY"
 
     def detail_columns(self, detail):
-        if detail == "matrix":
-            aggcols = ["median", "median", "median", "loss", "pingsent", "lossrate"]
-            aggfuncs = ["avg", "stddev", "count", "sum", "sum", "stddev"]
-        elif detail in ["basic", "spark", "tooltiptext"]:
-            aggcols = ["loss", "pingsent", "median"]
-            aggfuncs = ["sum", "sum", "avg"]
-        else:
-            aggcols = ["median", "pings", "loss", "pingsent"]
-            aggfuncs = ["avg", "smokearray", "sum", "sum"]
-
-        return aggcols, aggfuncs
+        return DETAIL_COLUMNS.get(detail, DEFAULT_DETAIL_COLUMNS)
 
     def calculate_binsize(self, start, end, detail):
         if (end - start) / 300.0 < 200:
@@ -79,7 +100,8 @@ class RRDSmokeping(Collection):
 
     def create_group_description(self, properties):
         if 'family' in properties:
-            properties['aggregation'] = properties['family'].upper()
+            properties = dict(properties,
+                    aggregation=properties['family'].upper())
 
         for p in self.groupproperties:
             if p not in properties:
@@ -92,47 +114,23 @@ class RRDSmokeping(Collection):
                 properties['aggregation'].upper())
 
     def parse_group_description(self, description):
-
-        regex = "SOURCE (?P<source>[.a-zA-Z0-9_-]+) "
-        regex += "TARGET (?P<host>\S+) "
-        regex += "(?P<split>[A-Z0-9]+)"
-
-        parts = self._apply_group_regex(regex, description)
+        parts = self._match_group_regex(GROUP_REGEX, description)
         if parts is None:
             return None
 
-        if parts.group('split') not in self.splits:
+        if parts['split'] not in self.splits:
             log("%s group description has no aggregation method" % \
                     (self.collection_name))
             log(description)
             return None
 
         keydict = {
-            'source':parts.group('source'),
-            'host':parts.group('host'),
-            'aggregation': parts.group('split'),
+            'source': parts['source'],
+            'host': parts['host'],
+            'aggregation': intern(parts['split']),
         }
         return keydict
 
-    def _generate_label(self, baselabel, search, family, lookup):
-        if family is None:
-            return None
-
-        key = baselabel + "_" + family
-        search['family'] = family.lower()
-        shortlabel = family
-
-        if lookup:
-            streams = self.streammanager.find_streams(search)
-            if streams is None:
-                log("Failed to find streams for label %s, %s" % \
-                        (key, self.collection_name))
-                return None
-        else:
-            streams = []
-
-        return {'labelstring': key, 'streams': streams, 'shortlabel':shortlabel}
-
     def group_to_labels(self, groupid, description, lookup=True):
 
         labels = []
@@ -146,33 +144,21 @@ class RRDSmokeping(Collection):
         search = {'source': groupparams['source'],
                 'host': groupparams['host']}
 
-        if groupparams['aggregation'] in ['IPV4', 'FAMILY']:
+        if groupparams['aggregation'] in IPV4_SPLITS:
             nextlab = self._generate_label(baselabel, search, "IPv4", lookup)
             if nextlab is None:
                 return None
             labels.append(nextlab)
 
-        if groupparams['aggregation'] in ['IPV6', 'FAMILY']:
-            nextlab = self._generate_label(baselabel, search, "IPv4", lookup)
+        if groupparams['aggregation'] in IPV6_SPLITS:
+            nextlab = self._generate_label(baselabel, search, "IPv6", lookup)
             if nextlab is None:
                 return None
             labels.append(nextlab)
 
-        return sorted(labels, key=itemgetter('shortlabel'))
-
-        if lookup:
-            streams = self.streammanager.find_streams(groupparams)
-            if streams is None:
-                log("Failed to find streams for label %s, %s" % \
-                        (key, self.collection_name))
-                return None
-            # No storage included with the streams so we should already have
-            # a list of stream IDs
-        else:
-            streams = []
-
-        return [{'labelstring':label, 'streams':streams, \
-                'shortlabel':groupparams['host']}]
+        # IPv4 labels are always added before IPv6 ones, so the list is
+        # already sorted by shortlabel
+        return labels
 
     def update_matrix_groups(self, cache, source, dest, optdict, groups,
             views, viewmanager, viewstyle):
@@ -29,12 +29,68 @@
 #
 
 import time
+import random
+from contextlib import contextmanager
+from functools import wraps
+from threading import Condition, Lock
 import psycopg2
 import psycopg2.extras
 from libnntscclient.logger import log
 
 # Generic psycopg2 database code largely borrowed from NNTSC
 
+# Upper limit on the delay between attempts to connect to the database
+MAX_RETRY_WAIT = 60
+
+# If the database disappears this many times within CIRCUIT_WINDOW seconds,
+# stop trying to reconnect and fail queries straight away for the next
+# CIRCUIT_COOLDOWN seconds
+CIRCUIT_FAILURES = 5
+CIRCUIT_WINDOW = 30
+CIRCUIT_COOLDOWN = 30
+
+# How long a single connection attempt made while serving a query may
+# take before we give up on it
+CONNECT_TIMEOUT = 10
+
+def _db_guarded(func):
+    """
+    Decorator for AmpyDatabase methods that talk to the database, so that
+    psycopg2 errors are handled the same way everywhere.
+
+    If an error occurs, the transaction is rolled back (or one attempt is
+    made to re-establish the connection if the database has gone away) and
+    the wrapped method returns -1.
+    """
+    @wraps(func)
+    def guarded(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        except psycopg2.extensions.QueryCanceledError:
+            self.conn.rollback()
+            return -1
+        except psycopg2.OperationalError:
+            log("Database %s appears to have disappeared" % (self.dbname))
+            self.destroy()
+            if not self._record_failure():
+                self.tryconnect()
+            return -1
+        except (psycopg2.ProgrammingError, psycopg2.IntegrityError,
+                psycopg2.DataError) as e:
+            log(e)
+            self.conn.rollback()
+            return -1
+        except KeyboardInterrupt:
+            return -1
+        except psycopg2.Error as e:
+            log(e)
+            try:
+                self.conn.rollback()
+            except psycopg2.InterfaceError as e:
+                log(e)
+            return -1
+    return guarded
+
 class AmpyDatabase(object):
     """
     Helper class for interacting with postgresql databases.
@@ -53,6 +109,8 @@ class AmpyDatabase(object):
     reconnect:
         Attempts to reconnect to the database after dropping the existing
         connection first. Will retry until the connection succeeds.
+    tryconnect:
+        Makes a single, time-limited attempt to (re)connect to the database.
     executequery:
         Executes the provided query using the current database connection.
         The database cursor may be used to access the query result.
@@ -64,6 +122,12 @@ class AmpyDatabase(object):
         not been configured to auto-commit.
     """
 
+    # Circuit breaker state for each database we talk to, keyed by
+    # connection string. This is shared by all of our connections to the
+    # same database so that they stop hammering it together.
+    circuits = {}
+    circuitlock = Lock()
+
     def __init__(self, dbconf, autocommit=False, name=None):
         """
         Init function for the AmpyDatabase class.
@@ -92,6 +156,7 @@ class AmpyDatabase(object):
 
         self.conn = None
         self.cursor = None
+        self.encoding = None
 
         assert('name' in dbconf)
         self.dbname = dbconf["name"]
@@ -122,15 +187,19 @@ class AmpyDatabase(object):
         Connects to the database.
 
         If the connection attempt fails, this function will sleep for a short
-        time and then try again.
+        time and then try again. The delay doubles after each failure (up to
+        MAX_RETRY_WAIT seconds) and is randomised, so that several ampy
+        processes do not all hit a restarted database at the same moment.
 
         Parameters:
-          retrywait -- the amount of time to sleep between connection attempts
+          retrywait -- the base amount of time to sleep between connection
+                       attempts
 
         Returns:
           0 always.
         """
         logmessage = False
+        attempts = 0
 
         while self.conn is None:
             try:
@@ -138,31 +207,36 @@ class AmpyDatabase(object):
             except psycopg2.DatabaseError as e:
                 if not logmessage:
                     log("Error connecting to %s database: %s" % (self.dbname, e))
-                    log("Retrying every %d seconds" % retrywait)
+                    log("Retrying with backoff of up to %d seconds" % \
+                            (MAX_RETRY_WAIT))
                     logmessage = True
                 self.conn = None
-                time.sleep(retrywait)
+                backoff = min(MAX_RETRY_WAIT, retrywait * (2 ** min(attempts, 6)))
+                time.sleep(random.uniform(0, backoff))
+                attempts += 1
 
-        if encoding:
-            self.conn.set_client_encoding(encoding)
-        self.conn.autocommit = self.autocommit
+        # Remember the encoding so that reconnecting keeps using it
+        if encoding is not None:
+            self.encoding = encoding
+        self._configure()
 
         if logmessage:
             log("Successfully connected to database %s" % (self.dbname))
 
-        self.cursor = None
         return 0
 
     def reconnect(self):
         """
-        After a brief sleep, attempts to re-connect to the database.
+        After a brief, randomised sleep, attempts to re-connect to the
+        database.
 
         Will close any existing connections before reconnecting.
         """
-        time.sleep(5)
+        time.sleep(random.uniform(0, 5))
         self.destroy()
         self.connect(5)
 
+    @_db_guarded
     def executequery(self, query, params):
         """
         Executes the given query against the current database.
@@ -176,48 +250,26 @@ class AmpyDatabase(object):
           -1 if an error occurs, 0 if the query executes successfully
         """
 
+        # Fail straight away if the database has been unreliable recently,
+        # otherwise try to replace any connection that we dropped
+        if self._circuitopen():
+            return -1
+        if self.conn is None and self.tryconnect() != 0:
+            return -1
+
         # Make sure we have a cursor available for the query
         if self.cursor is None:
             err = self._createcursor()
             if err != 0:
                 return err
 
-        try:
-            if params is not None:
-                self.cursor.execute(query, params)
-            else:
-                self.cursor.execute(query)
-
-        except psycopg2.extensions.QueryCanceledError:
-            self.conn.rollback()
-            return -1
-        except psycopg2.OperationalError:
-            log("Database %s appears to have disappeared -- reconnecting" % (self.dbname))
-            self.reconnect()
-            return -1
-        except psycopg2.ProgrammingError as e:
-            log(e)
-            self.conn.rollback()
-            return -1
-        except psycopg2.IntegrityError as e:
-            log(e)
-            self.conn.rollback()
-            return -1
-        except psycopg2.DataError as e:
-            log(e)
-            self.conn.rollback()
-            return -1
-        except KeyboardInterrupt:
-            return -1
-        except psycopg2.Error as e:
-            log(e)
-            try:
-                self.conn.rollback()
-            except InterfaceError as e:
-                log(e)
-            return -1
+        if params is not None:
+            self.cursor.execute(query, params)
+        else:
+            self.cursor.execute(query)
         return 0
 
+    @_db_guarded
     def closecursor(self):
         """
         Closes the currently active cursor for the database.
@@ -236,39 +288,11 @@ class AmpyDatabase(object):
             self.cursor = None
             return 0
 
-        try:
-            self.cursor.close()
-        except psycopg2.extensions.QueryCanceledError:
-            self.conn.rollback()
-            return -1
-        except psycopg2.OperationalError:
-            log("Database %s appears to have disappeared -- reconnecting" % (self.dbname))
-            self.reconnect()
-            return -1
-        except psycopg2.ProgrammingError as e:
-            log(e)
-            self.conn.rollback()
-            return -1
-        except psycopg2.IntegrityError as e:
-            log(e)
-            self.conn.rollback()
-            return -1
-        except psycopg2.DataError as e:
-            log(e)
-            self.conn.rollback()
-            return -1
-        except KeyboardInterrupt:
-            return -1
-        except psycopg2.Error as e:
-            log(e)
-            try:
-                self.conn.rollback()
-            except InterfaceError as e:
-                log(e)
-            return -1
+        self.cursor.close()
         self.cursor = None
         return 0
 
+    @_db_guarded
     def commit(self):
         """
         Commits the current transaction to the database.
@@ -284,38 +308,90 @@ class AmpyDatabase(object):
         if self.conn is None:
             return -1
 
-        try:
-            self.conn.commit()
-        except psycopg2.extensions.QueryCanceledError:
-            self.conn.rollback()
-            return -1
-        except psycopg2.OperationalError:
-            log("Database %s appears to have disappeared -- reconnecting" % (self.dbname))
-            self.reconnect()
-            return -1
-        except psycopg2.ProgrammingError as e:
-            log(e)
-            self.conn.rollback()
-            return -1
-        except psycopg2.IntegrityError as e:
-            log(e)
-            self.conn.rollback()
-            return -1
-        except psycopg2.DataError as e:
-            log(e)
-            self.conn.rollback()
-            return -1
-        except KeyboardInterrupt:
+        self.conn.commit()
+        return 0
+
+    def _configure(self):
+        """
+        Applies our connection settings to a newly opened connection.
+        """
+        if self.encoding:
+            self.conn.set_client_encoding(self.encoding)
+        self.conn.autocommit = self.autocommit
+        self.cursor = None
+
+    def tryconnect(self):
+        """
+        Makes a single attempt to connect to the database, dropping any
+        existing connection first.
+
+        Unlike connect(), this never retries and gives up after
+        CONNECT_TIMEOUT seconds, so it is safe to call while serving a
+        query. No attempt is made while the circuit breaker is open.
+
+        Returns -1 if the connection failed, 0 if successful
+        """
+        if self._circuitopen():
             return -1
-        except psycopg2.Error as e:
-            log(e)
-            try:
-                self.conn.rollback()
-            except InterfaceError as e:
-                log(e)
+
+        self.destroy()
+        try:
+            self.conn = psycopg2.connect(self.connstr,
+                    connect_timeout=CONNECT_TIMEOUT)
+        except psycopg2.DatabaseError as e:
+            log("Error connecting to %s database: %s" % (self.dbname, e))
+            self.conn = None
+            self._record_failure()
             return -1
+
+        self._configure()
         return 0
 
+    def _circuit(self):
+        """
+        Returns the circuit breaker state for our database. The caller
+        must be holding circuitlock.
+        """
+        if self.connstr not in self.circuits:
+            self.circuits[self.connstr] = {"failcount": 0,
+                    "firstfailure": 0, "openuntil": 0}
+        return self.circuits[self.connstr]
+
+    def _circuitopen(self):
+        """
+        Returns True if our database has been failing recently enough that
+        queries should not be attempted, False otherwise.
+        """
+        with self.circuitlock:
+            return time.time() < self._circuit()["openuntil"]
+
+    def _record_failure(self):
+        """
+        Records that the database connection has been lost or could not be
+        established.
+
+        Returns True if this has happened often enough recently that the
+        circuit breaker is now open, False otherwise.
+        """
+        now = time.time()
+        with self.circuitlock:
+            circuit = self._circuit()
+            if circuit["failcount"] == 0 or \
+                    now - circuit["firstfailure"] > CIRCUIT_WINDOW:
+                circuit["failcount"] = 0
+                circuit["firstfailure"] = now
+
+            circuit["failcount"] += 1
+            if circuit["failcount"] < CIRCUIT_FAILURES:
+                return False
+
+            circuit["failcount"] = 0
+            circuit["openuntil"] = now + CIRCUIT_COOLDOWN
+
+        log("Database %s keeps disappearing -- failing queries for %d seconds" % \
+                (self.dbname, CIRCUIT_COOLDOWN))
+        return True
+
     def _createcursor(self):
         """
         Creates a cursor using our current database connection
@@ -341,4 +417,134 @@ class AmpyDatabase(object):
 
         return 0
 
+class AmpyDatabasePool(object):
+    """
+    A pool of AmpyDatabase connections to the same database.
+
+    Lets threads that are serving different requests query the database
+    at the same time, rather than all queueing for a single connection.
+    Connections are created on demand, up to a fixed maximum, and are
+    reused once they are released back into the pool.
+
+    API Functions
+    -------------
+    acquire:
+        Takes a connection from the pool, creating a new one if none are
+        idle. Blocks if the maximum number of connections are in use.
+        Returns None if a new connection could not be opened.
+    release:
+        Returns a connection to the pool once the caller is done with it.
+    connection:
+        Context manager that acquires a connection and always releases it
+        again, even if an exception is raised.
+    destroy:
+        Closes all of the idle connections in the pool.
+    """
+
+    def __init__(self, dbconf, autocommit=False, maxconns=8):
+        """
+        Init function for the AmpyDatabasePool class.
+
+        Parameters:
+          dbconf -- a dictionary describing the configuration options
+                necessary for connecting to the database. See the
+                AmpyDatabase class for details.
+          autocommit -- a boolean flag indicating whether the transaction
+                should be automatically committed after each query.
+          maxconns -- the maximum number of connections to open at once.
+        """
+        self.dbconf = dbconf
+        self.autocommit = autocommit
+        self.maxconns = maxconns
+
+        self.idle = []
+        self.connections = 0
+        self.poolcond = Condition()
+
+    def acquire(self):
+        """
+        Takes a database connection from the pool.
+
+        If there are no idle connections, a new one is opened. If the
+        pool already has the maximum number of connections open, this
+        will block until another thread releases a connection.
+
+        Only one attempt is made to open a new connection, so this will
+        not hang if the database is down.
+
+        Returns:
+          a connected AmpyDatabase instance, or None if a new connection
+          was needed but could not be opened. The caller MUST pass any
+          returned instance to release() once they are finished with it.
+        """
+        with self.poolcond:
+            while not self.idle and self.connections >= self.maxconns:
+                self.poolcond.wait()
+
+            if self.idle:
+                return self.idle.pop()
+            self.connections += 1
+
+        # Connect outside of the lock so other threads can keep using
+        # the idle connections while we wait for the database
+        db = None
+        try:
+            db = AmpyDatabase(self.dbconf, self.autocommit)
+            if db.tryconnect() != 0:
+                db = None
+        finally:
+            # Give the slot back if we didn't end up with a connection
+            if db is None:
+                with self.poolcond:
+                    self.connections -= 1
+                    self.poolcond.notify()
+        return db
+
+    def release(self, db):
+        """
+        Returns a database connection to the pool.
+
+        Any cursor left open by the caller is closed first.
+
+        Parameters:
+          db -- the AmpyDatabase instance returned by acquire()
+        """
+        db.closecursor()
+
+        with self.poolcond:
+            self.idle.append(db)
+            self.poolcond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager for using a connection from the pool, e.g.
+
+            with pool.connection() as db:
+                ...
+
+        The connection is released back into the pool when the block
+        exits, however it exits.
+
+        Yields:
+          a connected AmpyDatabase instance, or None if a new connection
+          was needed but could not be opened.
+        """
+        db = self.acquire()
+        try:
+            yield db
+        finally:
+            if db is not None:
+                self.release(db)
+
+    def destroy(self):
+        """
+        Closes all of the idle connections in the pool.
+        """
+        with self.poolcond:
+            for db in self.idle:
+                db.destroy()
+            self.connections -= len(self.idle)
+            self.idle = []
+
 # vim: set sw=4 tabstop=4 softtabstop=4 expandtab :
@@ -28,10 +28,13 @@
 # Please report any bugs, questions or comments to contact@wand.net.nz
 #
 
-from threading import Lock
-from libampy.database import AmpyDatabase
+from operator import itemgetter
+from libampy.database import AmpyDatabasePool
 from libnntscclient.logger import log
 
+# Maximum number of per-stream event tables to combine into a single query
+MAX_UNION_STREAMS = 100
+
 class EventManager(object):
     """
     Class for interacting with the netevmon event database
@@ -79,9 +82,12 @@ class EventManager(object):
             eventdbconfig['name'] = "netevmon"
 
         self.dbconfig = eventdbconfig
-        self.db = AmpyDatabase(eventdbconfig, True)
-        self.db.connect(15)
-        self.dblock = Lock()
+        self.dbpool = AmpyDatabasePool(eventdbconfig, True)
+
+        # Open the first connection now, so that any problem reaching the
+        # database is reported at startup rather than on the first query
+        with self.dbpool.connection():
+            pass
 
     def fetch_specific_event(self, stream, eventid):
         """
@@ -100,21 +106,31 @@ class EventManager(object):
         if self.disabled:
             return None
 
-        self.dblock.acquire()
+        # The stream id becomes part of the table name, so make sure it
+        # really is a number before putting it in the query
+        try:
+            stream = int(stream)
+        except (TypeError, ValueError):
+            log("Invalid stream id while querying for a specific event: %s" \
+                    % (stream))
+            return None
 
-        stable = "eventing.events_str%s" % (stream)
+        stable = "eventing.events_str%d" % (stream)
         query = "SELECT * FROM " + stable
         query += " WHERE event_id = %s"
         params = (eventid,)
 
-        if self.db.executequery(query, params) == -1:
-            log("Error while querying for a specific event (%s %s)" % \
-                    (stream, eventid))
-            self.dblock.release()
-            return None
+        with self.dbpool.connection() as db:
+            if db is None:
+                return None
+            if db.executequery(query, params) == -1:
+                log("Error while querying for a specific event (%s %s)" % \
+                        (stream, eventid))
+                return None
 
-        result = self.db.cursor.fetchone()
-        self.dblock.release()
+            result = db.cursor.fetchone()
+        if result is None:
+            return None
         return dict(result)
 
     def fetch_events(self, labels, start, end):
@@ -142,49 +158,57 @@ class EventManager(object):
         events = []
         if self.disabled:
             return events
-        self.dblock.acquire()
+
+        streams = []
         for lab in labels:
             if 'streams' not in lab:
                 log("Error while fetching events: label has no associated streams")
                 return None
+            streams += lab['streams']
 
-            for stream in lab['streams']:
+        if len(streams) == 0:
+            return events
 
-                query = "SELECT count(*) FROM eventing.group_membership WHERE"
-                query += " stream = %s"
-                params = (stream,)
+        # Only streams that belong to an event group have an event table,
+        # so find out which ones those are with a single query
+        query = "SELECT DISTINCT stream FROM eventing.group_membership WHERE"
+        query += " stream = ANY(%s::integer[])"
+        params = (list(set(streams)),)
 
-                if self.db.executequery(query, params) == -1:
-                    log("Error while querying for events")
-                    self.dblock.release()
-                    return None
+        with self.dbpool.connection() as db:
+            if db is None:
+                return None
+            if db.executequery(query, params) == -1:
+                log("Error while querying for events")
+                return None
 
-                if self.db.cursor.fetchone()[0] == 0:
-                    continue
+            eventstreams = [row[0] for row in db.cursor]
+            db.closecursor()
 
-                stable = "eventing.events_str%s" % (stream)
-                query = "SELECT * FROM " + stable
-                query += " WHERE ts_started >= %s AND ts_started <= %s"
+            if len(eventstreams) == 0:
+                return events
 
-                params = (start, end)
+            found = self._fetch_stream_events(db,
+                    dict.fromkeys(eventstreams, (start, end)),
+                    "ts_started >= %s AND ts_started <= %s")
 
-                if self.db.executequery(query, params) == -1:
-                    log("Error while querying for events")
-                    self.dblock.release()
-                    return None
+        if found is None:
+            log("Error while querying for events")
+            return None
 
-                for row in self.db.cursor.fetchall():
-                    events.append(dict(row))
-                    events[-1]['stream'] = stream
+        streamevents = {}
+        for ev in found:
+            streamevents.setdefault(ev['stream'], []).append(ev)
 
-                    if 'groupid' in lab:
-                        events[-1]['groupid'] = lab['groupid']
-                    else:
-                        events[-1]['groupid'] = None
+        for lab in labels:
+            groupid = lab.get('groupid')
 
-                self.db.closecursor()
+            for stream in lab['streams']:
+                for ev in streamevents.get(stream, []):
+                    events.append(dict(ev))
+                    events[-1]['stream'] = stream
+                    events[-1]['groupid'] = groupid
 
-        self.dblock.release()
         return events
 
     def fetch_groups(self, start, end):
@@ -210,18 +234,17 @@ class EventManager(object):
                    AND ts_ended <= %s ORDER BY ts_started
                 """
         params = (start, end)
-        self.dblock.acquire()
-        if self.db.executequery(query, params) == -1:
-            log("Error while querying event groups")
-            self.dblock.release()
-            return None
+        with self.dbpool.connection() as db:
+            if db is None:
+                return None
+            if db.executequery(query, params) == -1:
+                log("Error while querying event groups")
+                return None
 
-        groups = []
+            groups = []
 
-        for row in self.db.cursor.fetchall():
-            groups.append(dict(row))
-        self.db.closecursor()
-        self.dblock.release()
+            for row in db.cursor:
+                groups.append(dict(row))
         return groups
 
     def fetch_event_group_members(self, groupid):
@@ -246,41 +269,100 @@ class EventManager(object):
                    WHERE group_id=%s
                 """
 
-        params = (str(groupid), )
-        self.dblock.acquire()
-        if self.db.executequery(query, params) == -1:
-            log("Error while querying event group membership")
-            self.dblock.release()
+        try:
+            params = (int(groupid), )
+        except (TypeError, ValueError):
+            log("Invalid event group id: %s" % (groupid))
+            return None
+
+        events = []
+        with self.dbpool.connection() as db:
+            if db is None:
+                return None
+            if db.executequery(query, params) == -1:
+                log("Error while querying event group membership")
+                return None
+
+            members = db.cursor.fetchall()
+            db.closecursor()
+
+            if len(members) == 0:
+                return events
+
+            # Now fetch the events within that group from the event tables
+            # for all of the member streams
+            streamevents = {}
+            collections = {}
+            for row in members:
+                streamevents.setdefault(row[2], []).append(row[1])
+                collections[(row[2], row[1])] = row[3]
+
+            found = self._fetch_stream_events(db,
+                    dict((s, (evids,)) for s, evids in streamevents.items()),
+                    "event_id = ANY(%s)", "ts_started")
+
+        if found is None:
+            log("Error while querying for members of event group %s" % \
+                    (groupid))
             return None
 
+        for ev in found:
+            ev['collection'] = collections.pop((ev['stream'], ev['event_id']),
+                    None)
+            events.append(ev)
+
+        for stream, evid in collections:
+            log("Event group member (%s,%s) does not exist" % \
+                    (str(stream), str(evid)))
+
+        return events
+
+    def _fetch_stream_events(self, db, streamparams, condition, orderby=None):
+        """
+        Fetches events from the event tables for a set of streams, querying
+        up to MAX_UNION_STREAMS tables in each UNION ALL statement.
+
+        Parameters:
+          db -- the database connection to query with
+          streamparams -- a dictionary mapping each stream id to the tuple
+                of parameters to substitute into the condition for that
+                stream
+          condition -- the WHERE clause to apply to each event table
+          orderby -- if not None, the column to sort the events by
+
+        Returns:
+          a list of event dictionaries, each with a 'stream' element
+          giving the stream whose table the event came from. Returns None
+          if a query fails.
+        """
+        streams = sorted(streamparams)
         events = []
-        members = self.db.cursor.fetchall()
-        self.db.closecursor()
-
-        for row in members:
-            # Now fetch the events within that group
-            stream = row[2]
-            evid = row[1]
-            colname = row[3]
-
-            query = "SELECT * from eventing.events_str%s" % (str(stream))
-            query += " WHERE event_id=%s"
-            params = (str(evid),)
-
-            if self.db.executequery(query, params) == -1:
-                log("Error while querying for event group member (%s,%s)" % \
-                        (str(stream), str(evid)))
-                self.dblock.release()
+
+        for i in range(0, len(streams), MAX_UNION_STREAMS):
+            batch = streams[i:i + MAX_UNION_STREAMS]
+            query = " UNION ALL ".join(
+                    "SELECT *, %d AS fetchstream FROM eventing.events_str%d" \
+                    " WHERE %s" % (s, s, condition) for s in batch)
+            if orderby is not None:
+                query += " ORDER BY %s" % (orderby)
+
+            params = []
+            for s in batch:
+                params.extend(streamparams[s])
+
+            if db.executequery(query, tuple(params)) == -1:
                 return None
 
-            evrow = self.db.cursor.fetchone()
-            events.append(dict(evrow))
-            events[-1]['stream'] = stream
-            events[-1]['collection'] = colname
+            for row in db.cursor:
+                ev = dict(row)
+                ev['stream'] = ev.pop('fetchstream')
+                events.append(ev)
+            db.closecursor()
 
-        self.db.closecursor()
-        self.dblock.release()
-        return sorted(events, key=lambda s: s['ts_started'])
+        # Each batch was sorted separately, so merge them back into order
+        if orderby is not None and len(streams) > MAX_UNION_STREAMS:
+            events.sort(key=itemgetter(orderby))
+        return events
 
     def get_event_filter(self, username, filtername):
         """
@@ -302,25 +384,23 @@ class EventManager(object):
         query = """SELECT * FROM eventing.userfilters WHERE user_id=%s AND filter_name=%s"""
         params = (username, filtername)
 
-        self.dblock.acquire()
-        if self.db.executequery(query, params) == -1:
-            log("Error while searching for event filter")
-            self.dblock.release()
-            return None
+        with self.dbpool.connection() as db:
+            if db is None:
+                return None
+            if db.executequery(query, params) == -1:
+                log("Error while searching for event filter")
+                return None
 
-        # Ideally, this shouldn't happen but let's try and do something
-        # sensible if it does
-        if self.db.cursor.rowcount > 1:
-            log("Warning: multiple event filters match the description %s %s" % (username, filtername))
-            log("Using first instance")
+            # Ideally, this shouldn't happen but let's try and do something
+            # sensible if it does
+            if db.cursor.rowcount > 1:
+                log("Warning: multiple event filters match the description %s %s" % (username, filtername))
+                log("Using first instance")
 
-        if self.db.cursor.rowcount == 0:
-            self.dblock.release()
-            return None
+            if db.cursor.rowcount == 0:
+                return None
 
-        filterdata = self.db.cursor.fetchone()
-        self.db.closecursor()
-        self.dblock.release()
+            filterdata = db.cursor.fetchone()
         return filterdata
 
     def create_event_filter(self, username, filtername, filterstring):
@@ -343,12 +423,12 @@ class EventManager(object):
         query = """INSERT INTO eventing.userfilters (user_id, filter_name, filter) VALUES (%s, %s, %s) """
         params = (username, filtername, filterstring)
 
-        self.dblock.acquire()
-        if self.db.executequery(query, params) == -1:
-            log("Error while inserting new event filter")
-            self.dblock.release()
-            return None
-        self.dblock.release()
+        with self.dbpool.connection() as db:
+            if db is None:
+                return None
+            if db.executequery(query, params) == -1:
+                log("Error while inserting new event filter")
+                return None
         return username, filtername
 
     def update_event_filter(self, username, filtername, filterstring, email):
@@ -368,15 +448,24 @@ class EventManager(object):
         if self.disabled:
             return None
 
+        # RETURNING tells us whether the filter existed without needing a
+        # separate query
         query = """ UPDATE eventing.userfilters SET filter = %s, email = %s
-                    WHERE user_id=%s AND filter_name=%s """
+                    WHERE user_id=%s AND filter_name=%s
+                    RETURNING user_id """
         params = (filterstring, email, username, filtername)
-        self.dblock.acquire()
-        if self.db.executequery(query, params) == -1:
-            log("Error while updating event filter")
-            self.dblock.release()
+        with self.dbpool.connection() as db:
+            if db is None:
+                return None
+            if db.executequery(query, params) == -1:
+                log("Error while updating event filter")
+                return None
+
+            updated = db.cursor.fetchone()
+        if updated is None:
+            log("Unable to update event filter %s for %s: no such filter" % \
+                    (filtername, username))
             return None
-        self.dblock.release()
         return username, filtername
 
     def delete_event_filter(self, username, filtername=None):
@@ -399,12 +488,12 @@ class EventManager(object):
         if filtername is not None:
             query += " AND filter_name=%s"
             params.append(filtername)
-        self.dblock.acquire()
-        if self.db.executequery(query, tuple(params)) == -1:
-            log("Error while removing event filter")
-            self.dblock.release()
-            return None
-        self.dblock.release()
+        with self.dbpool.connection() as db:
+            if db is None:
+                return None
+            if db.executequery(query, tuple(params)) == -1:
+                log("Error while removing event filter")
+                return None
         return username, filtername
 
 # vim: set smartindent shiftwidth=4 tabstop=4 softtabstop=4 expandtab :
@@ -34,6 +34,11 @@ from libnntscclient.protocol import *
 from libnntscclient.logger import log
 from libnntscclient.nntscclient import NNTSCClient
 
+# Defaults for how hard we try to reach NNTSC before giving up
+CONNECT_ATTEMPTS = 5
+CONNECT_TIMEOUT = 5
+MAX_RETRY_WAIT = 30
+
 class NNTSCConnection(object):
     """
     Class for querying a NNTSC database.
@@ -66,9 +71,11 @@ class NNTSCConnection(object):
         Configuration parameters:
           host: the host that is running the NNTSC you wish to connect to
           port: the port that NNTSC is listening on for clients
+          maxattempts: the number of times to try connecting to NNTSC
+                       before giving up
 
-          If unspecified, the host defaults to 'localhost' and the port
-          defaults to 61234.
+          If unspecified, the host defaults to 'localhost', the port
+          defaults to 61234 and maxattempts defaults to 5.
         """
 
         self.client = None
@@ -80,6 +87,10 @@ class NNTSCConnection(object):
             self.port = int(config['port'])
         else:
             self.port = 61234
+        if 'maxattempts' in config:
+            self.maxattempts = max(1, int(config['maxattempts']))
+        else:
+            self.maxattempts = CONNECT_ATTEMPTS
 
     def _connect(self):
         """
@@ -92,32 +103,41 @@ class NNTSCConnection(object):
         # If we've already got a connection, just use that
         if self.client is not None:
             return self.client
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        except socket.error as err:
-            log("Failed to create socket: %s" % err)
-            return None
 
+        sock = None
         attempts = 0
-        connected = False
 
-        # XXX Retry forever or die after a certain number of attempts?
-        while connected is False:
+        # Back off between attempts, but give up fairly quickly so that
+        # callers waiting on us (e.g. web requests) can report an error
+        # rather than hanging around until NNTSC comes back
+        while sock is None:
+            if attempts >= self.maxattempts:
+                log("Unable to connect to NNTSC after %d attempts" % (attempts))
+                return None
+
             if attempts > 0:
-                log("Retrying in 30 seconds (attempt %d)" % (attempts + 1))
-                time.sleep(30)
+                wait = min(2 ** attempts, MAX_RETRY_WAIT)
+                log("Retrying in %d seconds (attempt %d)" % (wait,
+                        attempts + 1))
+                time.sleep(wait)
 
             try:
-                sock.connect((self.host, self.port))
-                connected = True
+                sock = socket.create_connection((self.host, self.port),
+                        CONNECT_TIMEOUT)
             except socket.error as err:
                 log("Failed to connect to %s:%d -- %s" % (
                         self.host, self.port, err))
                 attempts += 1
 
-        if not connected:
-            log("Unable to connect to NNTSC after numerous attempts")
-            return None
+        # The timeout only applies to connecting, queries can take a while
+        sock.settimeout(None)
+
+        # Our requests are small, so don't let Nagle hold them back while
+        # waiting for an ACK
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error as err:
+            log("Failed to disable Nagle on NNTSC socket: %s" % err)
 
         self.client = NNTSCClient(sock)
         return self.client
@@ -240,7 +260,7 @@ class NNTSCConnection(object):
                 if msg[1]['collection'] != colid:
                     continue
 
-                streams += msg[1]['streams']
+                streams.extend(msg[1]['streams'])
                 if msg[1]['more'] is False:
                     break
             elif msg[0] == NNTSC_QUERY_CANCELLED:
@@ -341,7 +361,9 @@ class NNTSCConnection(object):
 
     def _parse_nntsc_history(self, colid, labels):
 
-        data = {}
+        # Every label will be answered before we return, so set up the
+        # result lists for all of them now
+        data = {lab: {"data": [], "timedout": []} for lab in labels}
         count = 0
 
         while count < len(labels):
@@ -365,12 +387,8 @@ class NNTSCConnection(object):
                     continue
 
                 for lab in msg[1]['labels']:
-                    if lab not in labels:
-                        continue
                     if lab not in data:
-                        data[lab] = {}
-                        data[lab]["data"] = []
-                        data[lab]["timedout"] = []
+                        continue
 
                     data[lab]['timedout'].append((msg[1]['start'], msg[1]['end']))
                     if msg[1]['more'] is False:
@@ -385,20 +403,17 @@ class NNTSCConnection(object):
                 if msg[1]['collection'] != colid:
                     continue
                 label = msg[1]['streamid']
-                if label not in labels:
-                    continue
                 if label not in data:
-                    data[label] = {}
-                    data[label]["data"] = []
-                    data[label]["timedout"] = []
-                    data[label]["freq"] = 0
+                    continue
+                entry = data[label]
+                entry.setdefault("freq", 0)
 
                 # it's possible the first few blocks have zero
                 # binsize/frequency if we asked for raw data and there was none
                 # available, so keep trying till we get a useful value
-                if data[label]["freq"] == 0 and msg[1]['binsize'] != None:
-                    data[label]["freq"] = msg[1]['binsize']
-                data[label]["data"] += msg[1]['data']
+                if entry["freq"] == 0 and msg[1]['binsize'] != None:
+                    entry["freq"] = msg[1]['binsize']
+                entry["data"].extend(msg[1]['data'])
                 if msg[1]['more'] is False:
                     # increment the count of completed labels
                     count += 1